@@ -1,15 +1,20 @@
 import os
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import time
 from datetime import datetime
 from flask import Flask, render_template, Response, request, jsonify
 import re
 from dotenv import load_dotenv
-import threading
 import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import random
-import glob
+import math
+import hashlib
+import diskcache
 
 load_dotenv()
 
@@ -19,6 +24,23 @@ SEED_TEXT = """Where are you? I swear I"""
 
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
+def sse_frame(payload):
+    """Serialize payload as a single SSE data frame (bytes)"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# SSE frames whose payload never changes, serialized once at startup
+COMPLETION_START_FRAMES = [sse_frame({'type': 'completion_start', 'index': i}) for i in range(1, 6)]
+GRADING_START_FRAME = sse_frame({'type': 'grading_start'})
+ITERATION_START_FMT = b'data: {"type":"iteration_start","iteration":%d}\n\n'
+
+# Grader replies are expected to contain a single standalone digit 1-5
+GRADER_CHOICE_RE = re.compile(r'\b([1-5])\b')
+GRADER_CHOICES = ('1', '2', '3', '4', '5')
+
+# Placeholders returned in place of a completion when no text could be generated
+NO_TOKEN_COMPLETION_TEXT = " [No API token configured]"
+FAILED_COMPLETION_TEXT = " [Completion failed]"
+
 # ============================
 # Configuration and Setup
 # ============================
@@ -42,6 +64,10 @@ DEFAULT_CONFIG = {
     'max_new_tokens': 128,
     'base_context_limit': 8000,
     'grader_context_limit': 4000,
+    'provider_order': [],
+    'grader_max_tokens': None,
+    'log_cache_usage': False,
+    'completion_workers': 64,
     'grader_prompt': 'Which of the following 5 completions of the given text is more interesting? reply with only a single number - 1, 2, 3, 4, 5. Remember, you\'re looking for the most *interesting* one.'
 }
 
@@ -71,8 +97,11 @@ def load_config():
 def save_config(config):
     """Save application configuration to file"""
     try:
-        with open(CONFIG_FILE, 'w') as f:
+        # Write a temp file and swap it in so a crash never leaves a half-written config
+        tmp_file = CONFIG_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(config, f, indent=2)
+        os.replace(tmp_file, CONFIG_FILE)
         return True
     except Exception as e:
         print(f"Error saving configuration: {e}")
@@ -88,146 +117,276 @@ INSTRUCT_MODEL = config['instruct_model']
 BASE_CONTEXT_LIMIT = config['base_context_limit']
 GRADER_CONTEXT_LIMIT = config['grader_context_limit']
 
-# Token is now loaded from config, with fallback to environment variable
+# Token is now loaded from config, with fallback to environment variable;
+# resolved once here and refreshed by /set_token rather than on every call
+API_TOKEN = config.get('token') or os.getenv("OPENROUTER_API_KEY")
+
+# Shared HTTP session so keep-alive connections to OpenRouter are reused
+# across calls instead of paying a fresh TCP+TLS handshake per completion
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=config['completion_workers'], max_retries=0))
+
+# Long-lived worker pool for the completion fan-out, so each iteration
+# reuses warm threads (and their pooled connections) instead of spawning new ones.
+# Every /generate stream holds up to 5 workers, including while backing off,
+# so size this for the number of concurrent streams expected
+COMPLETION_POOL = ThreadPoolExecutor(max_workers=config['completion_workers'], thread_name_prefix='completion')
+
+# Persistent response cache keyed on the full request parameters
+LLM_CACHE_DIR = os.path.join(CONFIG_DIR, 'llm_cache')
+LLM_CACHE = diskcache.Cache(LLM_CACHE_DIR, size_limit=500 * 1024 * 1024, eviction_policy='least-recently-used')
+
+def _cache_key(**params):
+    """Build a stable cache key from request parameters"""
+    return hashlib.sha256(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def _cache_get(key):
+    """Return cached response for key, or None on miss"""
+    try:
+        return LLM_CACHE.get(key)
+    except Exception as e:
+        print(f"Cache read failed: {e}")
+        return None
+
+def _cache_put(key, value):
+    """Store response under key"""
+    try:
+        LLM_CACHE.set(key, value)
+    except Exception as e:
+        print(f"Cache write failed: {e}")
 
-def get_completion_with_retry(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0, max_retries=10):
+def add_prompt_cache_hints(payload):
     """
-    Get single completion from OpenRouter API with retry logic
-    prompt = input text string
-    Returns completion text string, retries until success
+    Add OpenRouter provider routing so sibling requests can hit the same prefix
+    cache, plus usage accounting when log_cache_usage is enabled
+    payload = request payload dict, modified in place
+    Returns the payload
     """
-    # Use config token, fallback to environment variable
-    token = config.get('token') or os.getenv("OPENROUTER_API_KEY")
-    if not token:
-        return f" [No API token configured]"
+    # Pinning a provider order keeps sibling requests on the same backend,
+    # which is what makes its prefix (KV) cache hit
+    provider_order = config.get('provider_order')
+    if provider_order:
+        payload["provider"] = {"order": provider_order, "allow_fallbacks": True}
+    if config.get('log_cache_usage'):
+        payload["usage"] = {"include": True}
+    return payload
+
+def log_prompt_cache_usage(data, label):
+    """
+    Print prompt and cached prompt token counts when log_cache_usage is enabled
+    data = decoded response JSON (or final stream chunk)
+    label = prefix for the log message
+    """
+    if not config.get('log_cache_usage'):
+        return
+    usage = data.get("usage")
+    if not usage:
+        return
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+    print(f"{label} prompt tokens: {usage.get('prompt_tokens', 0)}, cached: {cached_tokens}")
+
+def get_api_headers():
+    """
+    Build OpenRouter request headers
+    Returns headers dict, or None if no API token is configured
+    """
+    if not API_TOKEN:
+        return None
     
-    headers = {
-        "Authorization": f"Bearer {token}",
+    return {
+        "Authorization": f"Bearer {API_TOKEN}",
         "Content-Type": "application/json"
     }
-    
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "min_p": 0.02
-    }
-    
+
+def backoff_delay(attempt, cap=60):
+    """
+    Full-jitter backoff: uniform over [0, capped exponential] so concurrent
+    workers that fail together don't retry in lockstep
+    attempt = zero-based attempt number
+    cap = maximum delay in seconds
+    Returns delay in seconds
+    """
+    return random.uniform(0, min(cap, 0.5 * 2 ** attempt))
+
+def rate_limit_delay(response, cap=65):
+    """
+    Delay to wait after a 429, honoring Retry-After when given in seconds
+    response = the rate-limited response
+    cap = maximum delay in seconds
+    Returns delay in seconds, clamped to [0, cap]
+    """
+    try:
+        delay = float(response.headers.get('Retry-After', 65))
+    except ValueError:
+        return 65
+    # Negative or NaN values would make time.sleep raise; huge ones would
+    # park a worker for hours
+    if not math.isfinite(delay):
+        return 65
+    return max(0.0, min(delay, cap))
+
+def retry_post(url, payload, headers, parse, max_retries=10, cap=60, label="API"):
+    """
+    POST to OpenRouter with retries and full-jitter exponential backoff
+    url = endpoint URL string
+    payload = JSON request body dict
+    headers = request headers dict
+    parse = callable mapping decoded response JSON to a result; raising retries
+    max_retries = number of attempts
+    cap = maximum backoff delay in seconds
+    label = prefix for log messages
+    Returns parsed result, or None if every attempt failed
+    """
     for attempt in range(max_retries):
+        delay = backoff_delay(attempt, cap)
         try:
-            response = requests.post(f"{OPENROUTER_BASE_URL}/completions", 
-                                   headers=headers, json=payload, timeout=60)
+            response = SESSION.post(url, headers=headers, json=payload, timeout=60)
             response.raise_for_status()
-            
-            data = response.json()
-            return data["choices"][0]["text"]
+            data = orjson.loads(response.content)
+            log_prompt_cache_usage(data, label)
+            return parse(data)
             
         except requests.exceptions.RequestException as e:
-            status_code = getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None
-            
-            # Calculate delay with short initial backoff, then exponential
-            if attempt == 0:
-                base_delay = 0.1
-            elif attempt == 1:
-                base_delay = 0.2
-            elif attempt == 2:
-                base_delay = 0.5
-            else:
-                base_delay = min(60, (2 ** (attempt - 1)))  # Cap at 60 seconds
-            jitter = random.uniform(0.0, 0.2)
-            delay = base_delay + jitter
+            response = getattr(e, 'response', None)
+            status_code = getattr(response, 'status_code', None)
             
-            # Special handling for rate limits
             if status_code == 429:
-                delay = 65  # Wait longer for rate limit (60s + jitter)
-                print(f"Rate limited on attempt {attempt + 1}, waiting {delay:.1f}s...")
+                delay = rate_limit_delay(response)
+                print(f"{label} rate limited on attempt {attempt + 1}, waiting {delay:.1f}s...")
             elif status_code in [502, 503, 408]:
-                print(f"Server error {status_code} on attempt {attempt + 1}, retrying in {delay:.1f}s...")
+                print(f"{label} server error {status_code} on attempt {attempt + 1}, retrying in {delay:.1f}s...")
             elif status_code in [401, 402, 403]:
-                print(f"Auth/credits error {status_code}, stopping retries")
+                print(f"{label} auth/credits error {status_code}, stopping retries")
                 break
             else:
-                print(f"API error on attempt {attempt + 1}: {e}, retrying in {delay:.1f}s...")
-            
-            if attempt < max_retries - 1:
-                time.sleep(delay)
-            
+                print(f"{label} error on attempt {attempt + 1}: {e}, retrying in {delay:.1f}s...")
+                
         except Exception as e:
-            print(f"Unexpected error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                if attempt == 0:
-                    delay = 0.1
-                elif attempt == 1:
-                    delay = 0.2
-                else:
-                    delay = min(10, 2 ** attempt) + random.uniform(0.0, 0.2)
-                time.sleep(delay)
+            print(f"{label} unexpected error on attempt {attempt + 1}: {e}, retrying in {delay:.1f}s...")
+        
+        if attempt < max_retries - 1:
+            time.sleep(delay)
+    
+    return None
+
+def completion_payload(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0):
+    """
+    Build the /completions request body shared by the streaming and
+    non-streaming paths, so both compute the same cache key
+    Returns payload dict
+    """
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "min_p": 0.02
+    }
+    return add_prompt_cache_hints(payload)
+
+def get_completion_with_retry(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0, max_retries=10, use_cache=False):
+    """
+    Get single completion from OpenRouter API with retry logic
+    prompt = input text string
+    use_cache = reuse cached responses even when sampling (temperature > 0)
+    Returns completion text string, retries until success
+    """
+    headers = get_api_headers()
+    if not headers:
+        return NO_TOKEN_COMPLETION_TEXT
+    
+    payload = completion_payload(prompt, model=model, max_tokens=max_tokens, temperature=temperature)
+    
+    # Sampled completions are only cached when the caller asks for it
+    cache_key = None
+    if use_cache or temperature == 0:
+        cache_key = _cache_key(**payload)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
+    
+    text = retry_post(f"{OPENROUTER_BASE_URL}/completions", payload, headers,
+                      parse=lambda data: data["choices"][0]["text"],
+                      max_retries=max_retries, label="Completion")
+    if text is not None:
+        if cache_key:
+            _cache_put(cache_key, text)
+        return text
     
     return f" [Completion failed after {max_retries} attempts]"
 
-def get_completion(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0):
+def is_failed_completion(text):
+    """Check whether text is a failure placeholder rather than generated text"""
+    return text == NO_TOKEN_COMPLETION_TEXT or text.startswith(FAILED_COMPLETION_TEXT[:-1])
+
+def get_completion(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0, use_cache=False):
     """
     Get single completion from OpenRouter API
     prompt = input text string  
+    use_cache = reuse cached responses even when sampling
     Returns completion text string
     """
-    return get_completion_with_retry(prompt, model, max_tokens, temperature)
+    return get_completion_with_retry(prompt, model, max_tokens, temperature, use_cache=use_cache)
 
-def stream_completion(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0):
+def stream_completion(prompt, model=BASE_MODEL, max_tokens=128, temperature=1.0, n=1):
     """
     Stream completion from OpenRouter API token by token
     prompt = input text string
-    Yields token strings as they arrive
+    n = number of completions to sample in the same request
+    Yields (choice index, token string) tuples as they arrive; raises if the request fails
     """
-    # Use config token, fallback to environment variable
-    token = config.get('token') or os.getenv("OPENROUTER_API_KEY")
-    if not token:
-        yield "data: " + json.dumps({"error": "No API token configured"}) + "\n\n"
-        return
+    headers = get_api_headers()
+    if not headers:
+        raise RuntimeError("No API token configured")
     
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+    payload = completion_payload(prompt, model=model, max_tokens=max_tokens, temperature=temperature)
+    payload["stream"] = True
+    if n > 1:
+        payload["n"] = n
     
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "max_tokens": max_tokens,
-        "temperature": temperature,
-        "min_p": 0.02,
-        "stream": True
-    }
-    
-    try:
-        with requests.post(f"{OPENROUTER_BASE_URL}/completions", 
-                          headers=headers, json=payload, stream=True, timeout=60) as r:
+    with SESSION.post(f"{OPENROUTER_BASE_URL}/completions", 
+                     headers=headers, json=payload, stream=True, timeout=60) as r:
+        if not r.ok:
+            # Read the error body while the connection is still open so
+            # callers can inspect it on the raised HTTPError
+            r.content
             r.raise_for_status()
-            buffer = ""
-            for chunk in r.iter_content(chunk_size=1024, decode_unicode=True):
-                if chunk:
-                    buffer += chunk
-                    while True:
-                        line_end = buffer.find('\n')
-                        if line_end == -1:
-                            break
-                        line = buffer[:line_end].strip()
-                        buffer = buffer[line_end + 1:]
-                        
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            if data == '[DONE]':
-                                return
-                            try:
-                                data_obj = json.loads(data)
-                                content = data_obj["choices"][0].get("text", "")
-                                if content:
-                                    yield content
-                            except json.JSONDecodeError:
-                                continue
-    except Exception as e:
-        print(f"Stream completion failed: {e}")
+        # iter_lines hands back complete raw byte lines; only the JSON payload
+        # of data lines gets decoded
+        for line in r.iter_lines(chunk_size=8192):
+            if not line.startswith(b'data: '):
+                continue
+            data = line[6:].strip()
+            if data == b'[DONE]':
+                return
+            try:
+                data_obj = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                continue
+            if "error" in data_obj:
+                raise RuntimeError(f"Stream error: {data_obj['error']}")
+            log_prompt_cache_usage(data_obj, "Stream")
+            for choice in data_obj.get("choices") or []:
+                yield choice.get("index", 0), choice.get("text") or ""
+
+def choice_from_logprobs(choice):
+    """
+    Pick the grader's answer from token logprobs instead of the sampled text
+    choice = a single entry of the chat response "choices" list
+    Returns integer index (1-5), or None if no option digit has logprobs
+    """
+    token_infos = (choice.get("logprobs") or {}).get("content") or []
+    for token_info in token_infos:
+        if token_info.get("token", "").strip() not in GRADER_CHOICES:
+            continue
+        # First digit position is the answer; take the most likely digit there
+        candidates = [
+            candidate for candidate in token_info.get("top_logprobs") or []
+            if candidate.get("token", "").strip() in GRADER_CHOICES
+        ] or [token_info]
+        best = max(candidates, key=lambda candidate: candidate.get("logprob", float('-inf')))
+        return int(best["token"].strip())
+    return None
 
 def get_grader_choice_with_retry(context, completions, max_retries=10, model=INSTRUCT_MODEL, grader_prompt=None):
     """
@@ -239,16 +398,10 @@ def get_grader_choice_with_retry(context, completions, max_retries=10, model=INS
     grader_prompt = custom prompt for grading (optional)
     Returns integer index (1-5) of chosen completion
     """
-    # Use config token, fallback to environment variable
-    token = config.get('token') or os.getenv("OPENROUTER_API_KEY")
-    if not token:
+    headers = get_api_headers()
+    if not headers:
         return random.randint(1, 5)  # Fallback to random choice
     
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
     options_text = ""
     for i, completion in enumerate(completions, 1):
         options_text += f"{i}. {completion}\n\n"
@@ -257,71 +410,58 @@ def get_grader_choice_with_retry(context, completions, max_retries=10, model=INS
     if grader_prompt is None:
         grader_prompt = config.get('grader_prompt', DEFAULT_CONFIG['grader_prompt'])
     
-    prompt = f"{context}\n\n{options_text}\n\n{grader_prompt}"
-    
+    # Context goes first as its own block marked cacheable; the options and
+    # instructions that change every call follow it
     payload = {
         "model": model,
         "messages": [
             {
                 "role": "user", 
-                "content": prompt
+                "content": [
+                    {
+                        "type": "text",
+                        "text": context,
+                        "cache_control": {"type": "ephemeral"}
+                    },
+                    {
+                        "type": "text",
+                        "text": f"\n\n{options_text}\n\n{grader_prompt}"
+                    }
+                ]
             }
         ]
     }
+    # Ask for the top alternatives at each position so the choice can be read
+    # straight off the digit's distribution; providers without logprobs ignore it
+    payload["logprobs"] = True
+    payload["top_logprobs"] = 5
+    grader_max_tokens = config.get('grader_max_tokens')
+    if grader_max_tokens:
+        payload["max_tokens"] = grader_max_tokens
+    add_prompt_cache_hints(payload)
     
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(f"{OPENROUTER_BASE_URL}/chat/completions",
-                                   headers=headers, json=payload, timeout=60)
-            response.raise_for_status()
-            
-            data = response.json()
-            choice_text = data["choices"][0]["message"]["content"].strip()
-            
-            match = re.search(r'\b([1-5])\b', choice_text)
-            if match:
-                return int(match.group(1))
-            else:
-                print(f"Grader gave weird response: {choice_text}, retrying...")
-                
-        except requests.exceptions.RequestException as e:
-            status_code = getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None
-            
-            if attempt == 0:
-                base_delay = 0.1
-            elif attempt == 1:
-                base_delay = 0.2
-            elif attempt == 2:
-                base_delay = 0.5
-            else:
-                base_delay = min(60, (2 ** (attempt - 1)))
-            jitter = random.uniform(0.0, 0.2)
-            delay = base_delay + jitter
-            
-            if status_code == 429:
-                delay = 65
-                print(f"Grader rate limited on attempt {attempt + 1}, waiting {delay:.1f}s...")
-            elif status_code in [502, 503, 408]:
-                print(f"Grader server error {status_code} on attempt {attempt + 1}, retrying in {delay:.1f}s...")
-            elif status_code in [401, 402, 403]:
-                print(f"Grader auth/credits error {status_code}, stopping retries")
-                break
-            else:
-                print(f"Grader API error on attempt {attempt + 1}: {e}, retrying in {delay:.1f}s...")
-            
-            if attempt < max_retries - 1:
-                time.sleep(delay)
-                
-        except Exception as e:
-            print(f"Grader unexpected error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                if attempt == 0:
-                    delay = 0.1
-                elif attempt == 1:
-                    delay = 0.2
-                else:
-                    delay = min(10, 2 ** attempt) + random.uniform(0.0, 0.2)
-                time.sleep(delay)
+    # Grader output is a single short choice, so it is always cached
+    cache_key = _cache_key(**payload)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+    
+    def parse_choice(data):
+        choice = choice_from_logprobs(data["choices"][0])
+        if choice is not None:
+            return choice
+        
+        choice_text = data["choices"][0]["message"]["content"].strip()
+        match = GRADER_CHOICE_RE.search(choice_text)
+        if not match:
+            raise ValueError(f"Grader gave weird response: {choice_text}")
+        return int(match.group(1))
+    
+    choice = retry_post(f"{OPENROUTER_BASE_URL}/chat/completions", payload, headers,
+                        parse=parse_choice, max_retries=max_retries, label="Grader")
+    if choice is not None:
+        _cache_put(cache_key, choice)
+        return choice
     
     fallback_choice = random.randint(1, 5)
     print(f"Grader failed after {max_retries} attempts, using random choice: {fallback_choice}")
@@ -352,33 +492,203 @@ def truncate_text(text, max_tokens):
     
     return text[-max_chars:]
 
-def generate_completions_parallel(prompt, count=5, max_tokens=128, temperature=1.0, min_p=0.02, model=BASE_MODEL):
+def extend_window(window, text, max_tokens):
+    """
+    Append text to a context window already bounded by truncate_text
+    window = current truncated context string
+    text = new text to append
+    max_tokens = integer limit for tokens
+    Returns updated window; cost is bounded by the window size, not the document
+    """
+    return truncate_text(window + text, max_tokens)
+
+# Models whose provider ignored or rejected "n", mapped to when that was seen;
+# these go straight to the fan-out until the entry expires
+_no_batch_models = {}
+NO_BATCH_RETRY_SECONDS = 3600
+# Matches a reference to the "n" parameter in a provider error message
+N_PARAM_RE = re.compile(r"""(?<![\w\\])['"`]?n['"`]?(?!\w)""")
+
+def batching_disabled(model):
+    """Check whether model recently ignored or rejected "n", expiring old entries"""
+    disabled_at = _no_batch_models.get(model)
+    if disabled_at is None:
+        return False
+    if time.time() - disabled_at > NO_BATCH_RETRY_SECONDS:
+        _no_batch_models.pop(model, None)
+        return False
+    return True
+
+def error_mentions_n(response):
     """
-    Generate multiple completions concurrently using threading
+    Check whether an error response blames the "n" parameter
+    response = the failed response, body already read
+    Returns True if the error message refers to n
+    """
+    try:
+        error = orjson.loads(response.content).get("error") or {}
+        message = error.get("message", "") if isinstance(error, dict) else str(error)
+    except (orjson.JSONDecodeError, AttributeError):
+        message = response.text
+    return bool(N_PARAM_RE.search(message))
+
+def stream_completions_parallel(prompt, count=5, max_tokens=128, temperature=1.0, min_p=0.02, model=BASE_MODEL):
+    """
+    Generate multiple completions concurrently, streaming tokens as they arrive
+    Batched into one request when the provider supports "n", otherwise one
+    streaming request per completion on the shared worker pool
     prompt = input text string
     count = number of completions to generate
     max_tokens = maximum tokens per completion
     temperature = temperature for generation
     min_p = min_p for generation
     model = model to use for generation
-    Returns list of completion text strings
+    Yields ('token', index, token) as text arrives, ('reset', index, '') when
+    streamed text for a slot is discarded after a failure, and ('done', index,
+    full text) once per completion, with index from 1 to count
     """
-    completions = [None] * count
-    threads = []
+    # Greedy completions are deterministic, so they share the completion cache
+    cache_key = None
+    if temperature == 0:
+        cache_key = _cache_key(**completion_payload(prompt, model=model, max_tokens=max_tokens, temperature=temperature))
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            for index in range(1, count + 1):
+                yield ('done', index, cached)
+            return
+    
+    events = queue.Queue()
+    
+    def finish(index, text):
+        if cache_key:
+            _cache_put(cache_key, text)
+        events.put(('done', index, text))
     
-    def worker(index):
-        completion = get_completion_with_retry(prompt, model=model, max_tokens=max_tokens, temperature=temperature)
-        completions[index] = completion
+    def submit_fan_out(index):
+        try:
+            COMPLETION_POOL.submit(fan_out_worker, index)
+        except Exception as e:
+            print(f"Could not start completion {index}: {e}")
+            events.put(('done', index, FAILED_COMPLETION_TEXT))
+    
+    def fan_out_worker(index):
+        parts = []
+        # Every exit path reports the slot as done, or the consumer waits forever
+        text = FAILED_COMPLETION_TEXT
+        try:
+            try:
+                for _, token in stream_completion(prompt, model=model, max_tokens=max_tokens, temperature=temperature):
+                    if token:
+                        parts.append(token)
+                        events.put(('token', index, token))
+            except Exception as e:
+                print(f"Stream for completion {index} failed: {e}")
+                # A cut-off stream is not a usable completion; drop what arrived
+                # and fall back to the retrying non-streaming call
+                if parts:
+                    events.put(('reset', index, ''))
+                text = get_completion_with_retry(prompt, model=model, max_tokens=max_tokens, temperature=temperature)
+                return
+            text = ''.join(parts)
+            if cache_key:
+                _cache_put(cache_key, text)
+        except Exception as e:
+            print(f"Completion {index} failed: {e}")
+        finally:
+            events.put(('done', index, text))
     
-    for i in range(count):
-        thread = threading.Thread(target=worker, args=(i,))
-        threads.append(thread)
-        thread.start()
+    def batch_worker():
+        # One request prefills the prompt once and samples every continuation
+        parts = {index: [] for index in range(1, count + 1)}
+        seen = set()
+        # Slots not yet finished or handed to a fan-out worker; any left when
+        # this worker exits are reported as failed so the consumer never hangs
+        pending = set(parts)
+        try:
+            try:
+                for choice_index, token in stream_completion(prompt, model=model, max_tokens=max_tokens, temperature=temperature, n=count):
+                    index = choice_index + 1
+                    if index not in parts:
+                        continue
+                    seen.add(index)
+                    if token:
+                        parts[index].append(token)
+                        events.put(('token', index, token))
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                status_code = getattr(response, 'status_code', None)
+                if status_code in [400, 422] and error_mentions_n(response):
+                    print(f"Model {model} rejected n={count} ({status_code}), using parallel requests")
+                    _no_batch_models[model] = time.time()
+                elif status_code == 429:
+                    delay = rate_limit_delay(response)
+                    print(f"Batch completion rate limited, waiting {delay:.1f}s before parallel requests...")
+                    time.sleep(delay)
+                elif status_code is not None and (status_code >= 500 or status_code == 408):
+                    delay = backoff_delay(0)
+                    print(f"Batch completion server error {status_code}, retrying in parallel in {delay:.1f}s...")
+                    time.sleep(delay)
+                else:
+                    print(f"Batch completion stream failed: {e}")
+                
+                # Partial continuations are discarded; every slot is regenerated
+                for index in range(1, count + 1):
+                    if parts[index]:
+                        events.put(('reset', index, ''))
+                    pending.discard(index)
+                    submit_fan_out(index)
+                return
+            
+            if len(seen) < count:
+                print(f"Model {model} did not return {count} completions for n={count}, using parallel requests")
+                _no_batch_models[model] = time.time()
+            
+            for index in range(1, count + 1):
+                pending.discard(index)
+                if index in seen:
+                    finish(index, ''.join(parts[index]))
+                else:
+                    submit_fan_out(index)
+        except Exception as e:
+            print(f"Batch completion failed: {e}")
+        finally:
+            for index in pending:
+                events.put(('done', index, FAILED_COMPLETION_TEXT))
     
-    for thread in threads:
-        thread.join()
+    if batching_disabled(model):
+        for index in range(1, count + 1):
+            submit_fan_out(index)
+    else:
+        try:
+            COMPLETION_POOL.submit(batch_worker)
+        except Exception as e:
+            print(f"Could not start batch completion: {e}")
+            for index in range(1, count + 1):
+                events.put(('done', index, FAILED_COMPLETION_TEXT))
     
-    return completions
+    remaining = count
+    while remaining:
+        event = events.get()
+        if event[0] == 'done':
+            remaining -= 1
+        yield event
+
+# Path separators, characters Windows forbids in file names, and control characters
+INVALID_NAME_CHARS_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+MAX_DOCUMENT_NAME_LENGTH = 100
+# Device names Windows reserves regardless of extension (CON.txt is the console)
+RESERVED_WINDOWS_NAMES = {'CON', 'PRN', 'AUX', 'NUL'} | {f'{device}{n}' for device in ('COM', 'LPT') for n in range(1, 10)}
+
+def is_valid_document_name(name):
+    """
+    Check that a document name maps to a plain file inside the documents directory
+    name = document name string
+    Returns True if the name is safe to use
+    """
+    return (0 < len(name) <= MAX_DOCUMENT_NAME_LENGTH
+            and not name.startswith('.')
+            and not INVALID_NAME_CHARS_RE.search(name)
+            and name.split('.', 1)[0].rstrip(' ').upper() not in RESERVED_WINDOWS_NAMES)
 
 def get_documents_dir():
     """Get or create documents directory"""
@@ -401,6 +711,7 @@ def save_document(name, content):
         # Simply overwrite the existing file - this is normal save behavior
         with open(filename, 'w', encoding='utf-8') as f:
             f.write(content)
+        invalidate_documents_cache()
         print(f"Saved document: {base_name}")
         # Return the actual saved name so callers/UI can update
         return base_name
@@ -418,9 +729,9 @@ def load_document(name):
         docs_dir = get_documents_dir()
         filename = os.path.join(docs_dir, f"{name}.txt")
         
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                return f.read()
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
         return None
     except Exception as e:
         print(f"Failed to load document {name}: {e}")
@@ -445,17 +756,31 @@ Respond with ONLY the document name, nothing else. Example formats:
 Document name:"""
     
     try:
-        response = get_completion(prompt, model=INSTRUCT_MODEL, max_tokens=20)
+        response = get_completion(prompt, model=INSTRUCT_MODEL, max_tokens=20, use_cache=True)
         # Clean up response - remove quotes, extra whitespace, newlines
         name = response.strip().strip('"').strip("'").strip()
+        # Drop anything that can't appear in a document file name
+        name = INVALID_NAME_CHARS_RE.sub('', name).lstrip('.').strip()
         # Ensure it's reasonable length
         if len(name) > 50:
             name = name[:50]
-        return name if name else "Untitled"
+        return name if is_valid_document_name(name) else "Untitled"
     except Exception as e:
         print(f"Error generating document name: {e}")
         return "Untitle"
 
+# Last documents listing, reused until the documents directory changes.
+# generation is bumped on every invalidation so a scan that raced with a
+# save doesn't store its stale result
+_docs_cache = {'mtime': None, 'data': [], 'generation': 0}
+_docs_cache_lock = threading.Lock()
+
+def invalidate_documents_cache():
+    """Force the next list_documents call to rescan the directory"""
+    with _docs_cache_lock:
+        _docs_cache['generation'] += 1
+        _docs_cache['mtime'] = None
+
 def list_documents():
     """
     List all documents with metadata
@@ -463,20 +788,31 @@ def list_documents():
     """
     try:
         docs_dir = get_documents_dir()
-        pattern = os.path.join(docs_dir, "*.txt")
-        files = glob.glob(pattern)
+        # Directory mtime only changes when entries are added/removed/renamed;
+        # in-place saves invalidate the cache explicitly
+        with _docs_cache_lock:
+            generation = _docs_cache['generation']
+            mtime = os.stat(docs_dir).st_mtime
+            if mtime == _docs_cache['mtime']:
+                return _docs_cache['data']
         
+        # scandir hands back stat data with each entry, avoiding a second stat per file
         documents = []
-        for filepath in files:
-            name = os.path.splitext(os.path.basename(filepath))[0]
-            stat = os.stat(filepath)
-            documents.append({
-                'name': name,
-                'modified': stat.st_mtime
-            })
+        with os.scandir(docs_dir) as entries:
+            for entry in entries:
+                # glob skipped dotfiles, so hidden files stay out of the listing
+                if entry.name.endswith('.txt') and not entry.name.startswith('.') and entry.is_file():
+                    documents.append({
+                        'name': entry.name[:-4],
+                        'modified': entry.stat().st_mtime
+                    })
         
         # Sort by modification time, newest first
         documents.sort(key=lambda x: x['modified'], reverse=True)
+        with _docs_cache_lock:
+            if _docs_cache['generation'] == generation:
+                _docs_cache['mtime'] = mtime
+                _docs_cache['data'] = documents
         return documents
     except Exception as e:
         print(f"Failed to list documents: {e}")
@@ -491,11 +827,13 @@ def index():
 @app.route('/set_token', methods=['POST'])
 def set_token():
     """Set the API token"""
+    global API_TOKEN
     token = request.form.get('token')
     if not token:
         return jsonify({'success': False, 'error': 'No token provided'})
     
     config['token'] = token
+    API_TOKEN = token
     if save_config(config):
         return jsonify({'success': True})
     else:
@@ -531,6 +869,9 @@ def api_save_document():
     if not name:
         return jsonify({'error': 'Document name required'}), 400
     
+    if not is_valid_document_name(name):
+        return jsonify({'error': 'Invalid document name'}), 400
+    
     saved_name = save_document(name, content)
     if saved_name:
         return jsonify({'message': 'Document saved successfully', 'name': saved_name})
@@ -540,6 +881,9 @@ def api_save_document():
 @app.route('/api/documents/load/<name>')
 def api_load_document(name):
     """API endpoint to load a document"""
+    if not is_valid_document_name(name):
+        return jsonify({'error': 'Invalid document name'}), 400
+    
     content = load_document(name)
     if content is not None:
         return jsonify({'name': name, 'content': content})
@@ -556,19 +900,26 @@ def api_rename_document():
     if not old_name or not new_name:
         return jsonify({'error': 'Both old_name and new_name required'}), 400
     
+    if not is_valid_document_name(old_name) or not is_valid_document_name(new_name):
+        return jsonify({'error': 'Invalid document name'}), 400
+    
     try:
         docs_dir = get_documents_dir()
         old_filename = os.path.join(docs_dir, f"{old_name}.txt")
         new_filename = os.path.join(docs_dir, f"{new_name}.txt")
         
-        if not os.path.exists(old_filename):
-            return jsonify({'error': 'Document not found'}), 404
-        
+        # os.rename silently replaces an existing target on POSIX, so the
+        # target still has to be checked; a missing source is caught below
         if os.path.exists(new_filename):
             return jsonify({'error': 'Document with new name already exists'}), 400
         
         os.rename(old_filename, new_filename)
+        invalidate_documents_cache()
         return jsonify({'message': f'Document renamed from "{old_name}" to "{new_name}"'})
+    except FileNotFoundError:
+        return jsonify({'error': 'Document not found'}), 404
+    except FileExistsError:
+        return jsonify({'error': 'Document with new name already exists'}), 400
     except Exception as e:
         print(f"Failed to rename document {old_name} to {new_name}: {e}")
         return jsonify({'error': 'Failed to rename document'}), 500
@@ -576,15 +927,18 @@ def api_rename_document():
 @app.route('/api/documents/delete/<name>', methods=['DELETE'])
 def api_delete_document(name):
     """API endpoint to delete a document"""
+    if not is_valid_document_name(name):
+        return jsonify({'error': 'Invalid document name'}), 400
+    
     try:
         docs_dir = get_documents_dir()
         filename = os.path.join(docs_dir, f"{name}.txt")
         
-        if os.path.exists(filename):
-            os.remove(filename)
-            return jsonify({'message': f'Document "{name}" deleted successfully'})
-        else:
-            return jsonify({'error': 'Document not found'}), 404
+        os.remove(filename)
+        invalidate_documents_cache()
+        return jsonify({'message': f'Document "{name}" deleted successfully'})
+    except FileNotFoundError:
+        return jsonify({'error': 'Document not found'}), 404
     except Exception as e:
         print(f"Failed to delete document {name}: {e}")
         return jsonify({'error': 'Failed to delete document'}), 500
@@ -598,14 +952,17 @@ def save_models():
         grader_model = data.get('grader_model')
         grader_prompt = data.get('grader_prompt')
         
-        if base_model:
-            config['model'] = base_model
-        if grader_model:
-            config['instruct_model'] = grader_model
-        if grader_prompt:
-            config['grader_prompt'] = grader_prompt
-            
-        save_config(config)
+        updates = {
+            'model': base_model,
+            'instruct_model': grader_model,
+            'grader_prompt': grader_prompt
+        }
+        changed = {key: value for key, value in updates.items() if value and config.get(key) != value}
+        
+        # Skip the disk write when the client resends the current settings
+        if changed:
+            config.update(changed)
+            save_config(config)
         
         return jsonify({'message': 'Models saved successfully'})
     except Exception as e:
@@ -644,69 +1001,90 @@ def generate():
     grader_model = request.args.get('grader_model', INSTRUCT_MODEL)
     grader_prompt = request.args.get('grader_prompt', None)
     
-    # Save the models for next time
-    if base_model != BASE_MODEL or grader_model != INSTRUCT_MODEL:
+    # Save the models for next time, only when they actually changed
+    if base_model != config.get('model') or grader_model != config.get('instruct_model'):
         config['model'] = base_model
         config['instruct_model'] = grader_model
         save_config(config)
     
     def generate_stream():
+        # Without a token every call fails instantly and the loop would spin
+        if not API_TOKEN:
+            yield sse_frame({'type': 'error', 'message': 'No API token configured'})
+            return
+        
         full_text = seed_text
+        # Rolling context windows, extended as text is chosen instead of
+        # re-slicing the whole document every iteration
+        base_context = truncate_text(full_text, BASE_CONTEXT_LIMIT)
+        grader_context = truncate_text(full_text, GRADER_CONTEXT_LIMIT)
         
-        yield f"data: {json.dumps({'type': 'init', 'text': full_text})}\n\n"
+        yield sse_frame({'type': 'init', 'text': full_text})
         
         iteration = 0
-        while True:  # Endless looming
-            iteration += 1
-            
-            yield f"data: {json.dumps({'type': 'iteration_start', 'iteration': iteration})}\n\n"
-            
-            base_context = truncate_text(full_text, BASE_CONTEXT_LIMIT)
-            
-            yield f"data: {json.dumps({'type': 'completion_start', 'index': 1})}\n\n"
-            yield f"data: {json.dumps({'type': 'completion_start', 'index': 2})}\n\n"
-            yield f"data: {json.dumps({'type': 'completion_start', 'index': 3})}\n\n"
-            yield f"data: {json.dumps({'type': 'completion_start', 'index': 4})}\n\n"
-            yield f"data: {json.dumps({'type': 'completion_start', 'index': 5})}\n\n"
-            
-            completions = generate_completions_parallel(base_context, count=5, max_tokens=max_new_tokens, temperature=temperature, min_p=min_p, model=base_model)
-            
-            for i, completion_text in enumerate(completions, 1):
-                yield f"data: {json.dumps({'type': 'completion_done', 'index': i, 'text': completion_text})}\n\n"
-            
-            yield f"data: {json.dumps({'type': 'grading_start'})}\n\n"
-            
-            grader_context = truncate_text(full_text, GRADER_CONTEXT_LIMIT)
-            chosen_index = get_grader_choice(grader_context, completions, model=grader_model, grader_prompt=grader_prompt)
-            
-            if chosen_index and 1 <= chosen_index <= len(completions):
-                chosen_text = completions[chosen_index - 1]
-                yield f"data: {json.dumps({'type': 'grading_done', 'chosen_index': chosen_index, 'chosen_text': chosen_text})}\n\n"
+        try:
+            while True:  # Endless looming
+                iteration += 1
                 
-                full_text += chosen_text
-                yield f"data: {json.dumps({'type': 'text_updated', 'full_text': full_text})}\n\n"
+                yield ITERATION_START_FMT % iteration
                 
-                # After 3 iterations, generate a document name
-                if iteration == 3:
-                    try:
-                        document_name = generate_document_name(full_text)
-                        yield f"data: {json.dumps({'type': 'document_named', 'name': document_name})}\n\n"
-                    except Exception as e:
-                        print(f"Failed to generate document name: {e}")
+                for frame in COMPLETION_START_FRAMES:
+                    yield frame
                 
-            else:
-                yield f"data: {json.dumps({'type': 'error', 'message': 'Grader failed'})}\n\n"
-                break
-            
-            time.sleep(1)
+                # Forward tokens as they stream in; grading still waits for all 5
+                completions = [None] * 5
+                partial_texts = [''] * 5
+                for kind, i, text in stream_completions_parallel(base_context, count=5, max_tokens=max_new_tokens, temperature=temperature, min_p=min_p, model=base_model):
+                    if kind == 'token':
+                        partial_texts[i - 1] += text
+                        yield sse_frame({'type': 'completion_token', 'index': i, 'token': text, 'full_text': partial_texts[i - 1]})
+                    elif kind == 'reset':
+                        # Failed stream is being regenerated; clear what the client shows
+                        partial_texts[i - 1] = ''
+                        yield sse_frame({'type': 'completion_token', 'index': i, 'token': '', 'full_text': ''})
+                    else:
+                        completions[i - 1] = text
+                        yield sse_frame({'type': 'completion_done', 'index': i, 'text': text})
+                
+                # Stop rather than loop on instant failures (e.g. a revoked key)
+                if all(is_failed_completion(text) for text in completions):
+                    yield sse_frame({'type': 'error', 'message': 'All completions failed'})
+                    break
+                
+                yield GRADING_START_FRAME
+                
+                chosen_index = get_grader_choice(grader_context, completions, model=grader_model, grader_prompt=grader_prompt)
+                
+                if chosen_index and 1 <= chosen_index <= len(completions):
+                    chosen_text = completions[chosen_index - 1]
+                    yield sse_frame({'type': 'grading_done', 'chosen_index': chosen_index, 'chosen_text': chosen_text})
+                    
+                    full_text += chosen_text
+                    base_context = extend_window(base_context, chosen_text, BASE_CONTEXT_LIMIT)
+                    grader_context = extend_window(grader_context, chosen_text, GRADER_CONTEXT_LIMIT)
+                    yield sse_frame({'type': 'text_updated', 'full_text': full_text})
+                    
+                    # After 3 iterations, generate a document name
+                    if iteration == 3:
+                        try:
+                            document_name = generate_document_name(full_text)
+                            yield sse_frame({'type': 'document_named', 'name': document_name})
+                        except Exception as e:
+                            print(f"Failed to generate document name: {e}")
+                    
+                else:
+                    yield sse_frame({'type': 'error', 'message': 'Grader failed'})
+                    break
+        except GeneratorExit:
+            # Client went away; stop instead of paying for completions nobody sees
+            print(f"Client disconnected during iteration {iteration}, stopping generation")
     
     return Response(generate_stream(), mimetype='text/event-stream',
                    headers={'Cache-Control': 'no-cache'})
 
 if __name__ == '__main__':
     # Check if token is configured (either in config or environment)
-    token = config.get('token') or os.getenv("OPENROUTER_API_KEY")
-    if not token:
+    if not API_TOKEN:
         print("No OpenRouter API token found. Please set token via web interface or .env file")
         print("Starting server anyway - token can be set via web interface...")
     
@@ -0,0 +1,5 @@
+"""
+WSGI entry point for serving self-loom with a production server, e.g.
+gunicorn -k gevent -w 1 --worker-connections 200 -b 0.0.0.0:5000 --timeout 0 wsgi:app
+"""
+from server import app